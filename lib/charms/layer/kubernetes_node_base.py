@@ -10,6 +10,13 @@ from charms.reactive import is_state
 from charmhelpers.core import hookenv, unitdata
 
 db = unitdata.kv()
+_JUJU_CLOUD_LABELS = {
+    "aws": "ec2",
+    "gcp": "gce",
+    "openstack": "openstack",
+    "vsphere": "vsphere",
+    "azure": "azure",
+}
 
 
 class LabelMaker:
@@ -20,22 +27,37 @@ class LabelMaker:
 
         pass
 
-    def __init__(self, kubeconfig_path: Union[PathLike, str]):
+    def __init__(
+        self,
+        kubeconfig_path: Union[PathLike, str],
+        backoff_cap: int = 30,
+        backoff_factor: int = 2,
+    ):
         self.kubeconfig_path = kubeconfig_path
         self.node = get_node_name()
-
-    @staticmethod
-    def _retried_call(cmd: List[str], retry_msg: str, timeout: int = 180) -> bool:
-        deadline = time.time() + timeout
-        while time.time() < deadline:
+        self._base_argv = ["kubectl", f"--kubeconfig={kubeconfig_path}"]
+        self.backoff_cap = backoff_cap
+        self.backoff_factor = backoff_factor
+
+    def _retried_call(self, cmd: List[str], retry_msg: str, timeout: int = 180) -> bool:
+        deadline = time.monotonic() + timeout
+        delay = 1.0
+        while time.monotonic() < deadline:
             code = call(cmd)
             if code == 0:
                 return True
             hookenv.log(retry_msg)
-            time.sleep(1)
+            # never sleep past the deadline, so the overall timeout is unchanged
+            time.sleep(
+                max(0, min(delay, self.backoff_cap, deadline - time.monotonic()))
+            )
+            delay *= self.backoff_factor
         else:
             return False
 
+    def _kubectl(self, *args: str) -> List[str]:
+        return [*self._base_argv, *args]
+
     def set_label(self, label: str, value: str) -> None:
         """
         Add a label to this node.
@@ -44,10 +66,11 @@ class LabelMaker:
         @param str value: Value to associate with the label
         @raises LabelMaker.NodeLabelError: if the label cannot be added
         """
-        cmd = "kubectl --kubeconfig={0} label node {1} {2}={3} --overwrite"
-        cmd = cmd.format(self.kubeconfig_path, self.node, label, value)
+        cmd = self._kubectl(
+            "label", "node", self.node, f"{label}={value}", "--overwrite"
+        )
         retry_msg = "Failed to apply label {0}={1}. Will retry.".format(label, value)
-        if not LabelMaker._retried_call(cmd.split(), retry_msg):
+        if not self._retried_call(cmd, retry_msg):
             raise LabelMaker.NodeLabelError(retry_msg)
 
     def remove_label(self, label: str) -> None:
@@ -57,10 +80,9 @@ class LabelMaker:
         @param str label: Label name to remove
         @raises LabelMaker.NodeLabelError: if the label cannot be removed
         """
-        cmd = "kubectl --kubeconfig={0} label node {1} {2}-"
-        cmd = cmd.format(self.kubeconfig_path, self.node, label)
+        cmd = self._kubectl("label", "node", self.node, f"{label}-")
         retry_msg = "Failed to remove label {0}. Will retry.".format(label)
-        if not LabelMaker._retried_call(cmd.split(), retry_msg):
+        if not self._retried_call(cmd, retry_msg):
             raise LabelMaker.NodeLabelError(retry_msg)
 
     def apply_node_labels(self) -> None:
@@ -73,50 +95,38 @@ class LabelMaker:
         # Get the user's configured labels.
         config = hookenv.config()
         user_labels = {}
-        for item in config.get("labels").split(" "):
-            try:
-                key, val = item.split("=")
-            except ValueError:
+        for item in config.get("labels").split():
+            key, sep, val = item.partition("=")
+            if not key or not sep or "=" in val:
                 hookenv.log("Skipping malformed option: {}.".format(item))
-            else:
-                user_labels[key] = val
+                continue
+            user_labels[key] = val
         # Collect the current label state.
         current_labels = db.get("current_labels") or {}
 
-        try:
-            # Remove any labels that the user has removed from the config.
-            for key in list(current_labels.keys()):
-                if key not in user_labels:
-                    self.remove_label(key)
-                    del current_labels[key]
-                    db.set("current_labels", current_labels)
-
-            # Add any new labels.
-            for key, val in user_labels.items():
-                self.set_label(key, val)
-                current_labels[key] = val
-                db.set("current_labels", current_labels)
-
-            # Set the juju-application and juju-charm labels.
-            self.set_label("juju-application", hookenv.service_name())
-            self.set_label("juju-charm", hookenv.charm_name())
-
-            # Set the juju.io/cloud label.
-            juju_io_cloud_labels = [
-                ("aws", "ec2"),
-                ("gcp", "gce"),
-                ("openstack", "openstack"),
-                ("vsphere", "vsphere"),
-                ("azure", "azure"),
-            ]
-            for endpoint, label in juju_io_cloud_labels:
-                if is_state("endpoint.{0}.ready".format(endpoint)):
-                    self.set_label("juju.io/cloud", label)
-                    break
-            else:
-                # none of the endpoints matched, remove the label
-                self.remove_label("juju.io/cloud")
-
-        except self.NodeLabelError as ex:
-            hookenv.log(str(ex))
-            raise
+        # Add the user's labels, plus the juju-application and juju-charm labels.
+        to_set = dict(user_labels)
+        to_set["juju-application"] = hookenv.service_name()
+        to_set["juju-charm"] = hookenv.charm_name()
+
+        # Set the juju.io/cloud label.
+        for endpoint, label in _JUJU_CLOUD_LABELS.items():
+            if is_state("endpoint.{0}.ready".format(endpoint)):
+                to_set["juju.io/cloud"] = label
+                break
+
+        # Remove any labels that the user has removed from the config, unless
+        # they're still set above; kubectl rejects `k-` and `k=v` together.
+        to_remove = sorted(current_labels.keys() - to_set.keys())
+        if "juju.io/cloud" not in to_set and "juju.io/cloud" not in to_remove:
+            # none of the endpoints matched, remove the label
+            to_remove.append("juju.io/cloud")
+
+        # Apply every change with a single kubectl invocation.
+        args = ["{}-".format(key) for key in to_remove]
+        args += ["{}={}".format(key, val) for key, val in to_set.items()]
+        cmd = self._kubectl("label", "node", self.node, *args, "--overwrite")
+        retry_msg = "Failed to apply labels. Will retry."
+        if not self._retried_call(cmd, retry_msg):
+            raise LabelMaker.NodeLabelError(retry_msg)
+        db.set("current_labels", user_labels)
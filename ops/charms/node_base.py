@@ -1,15 +1,23 @@
 """Library shared between kubernetes control plane and kubernetes worker charms."""
 
+import base64
+import http.client
 import json
 import logging
-import shlex
 import ops
-from subprocess import run
+import os
+import re
+import shutil
+import ssl
+import yaml
+from subprocess import DEVNULL, PIPE, run
 from os import PathLike
 from pathlib import Path
+from urllib.parse import quote, urlsplit
+from urllib.request import getproxies, proxy_bypass
 
 import time
-from typing import Union, List, Mapping, Optional, Protocol, Tuple
+from typing import Any, Dict, Iterable, Union, List, Mapping, Optional, Protocol, Tuple
 
 try:
     from typing import Annotated, TypeAlias
@@ -19,8 +27,35 @@ except ImportError:
     # if Annotated is not available, just use int
     PositiveInt = int
 
+try:
+    # orjson decodes several times faster, its errors subclass json.JSONDecodeError
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
 log = logging.getLogger(__name__)
 DEFAULT_TIMEOUT = 180
+BACKOFF_INITIAL = 0.1
+BACKOFF_MAX = 10
+BACKOFF_FACTOR = 2
+API_TIMEOUT = 30
+# kubectl errors which no amount of retrying will fix. NotFound is left out,
+# the node may simply not be registered with the API server yet.
+_PERMANENT_ERRORS = (
+    b"Forbidden",
+    b"Invalid value",
+    b"is invalid",
+    b"not a valid label",
+)
+_JUJU_CLOUD_LABELS = {
+    "aws": "ec2",
+    "gcp": "gce",
+    "openstack": "openstack",
+    "vsphere": "vsphere",
+    "azure": "azure",
+}
+# a key=value label token, with exactly one "="
+_LABEL_RE = re.compile(r"(?P<key>[^=\s]+)=(?P<value>[^=\s]*)")
 
 
 class Charm(Protocol):
@@ -41,7 +76,129 @@ def _is_kubectl(p: PathLike) -> bool:
     Returns:
         bool: True if the path exists, False otherwise.
     """
-    return Path(p).exists()
+    return os.path.exists(p)
+
+
+class _KubeAPI:
+    """Minimal in-process client for the Kubernetes API server.
+
+    Keeps one HTTPS connection open so repeated requests share a TLS session.
+    Only bearer token authentication is supported, anything else is left to
+    kubectl.
+    """
+
+    class Error(Exception):
+        """Raised when the API server cannot be reached or rejects a request."""
+
+    class Unreachable(Error):
+        """Raised when the API server cannot be reached at all."""
+
+    def __init__(self, server: str, token: str, context: ssl.SSLContext) -> None:
+        url = urlsplit(server)
+        self._host, self._port = url.hostname, url.port
+        self._prefix = url.path.rstrip("/")
+        self._token = token
+        self._context = context
+        self._conn: Optional[http.client.HTTPSConnection] = None
+
+    @classmethod
+    def from_kubeconfig(cls, path: Union[PathLike, str]) -> Optional["_KubeAPI"]:
+        """Build a client from the current context of a kubeconfig file.
+
+        Args:
+            path (Union[PathLike, str]): Path to the kubeconfig file.
+
+        Returns:
+            Optional[_KubeAPI]: The client, or None if the kubeconfig is unusable.
+        """
+        try:
+            config = yaml.safe_load(Path(path).read_text())
+            contexts = {c["name"]: c["context"] for c in config["contexts"]}
+            clusters = {c["name"]: c["cluster"] for c in config["clusters"]}
+            users = {u["name"]: u["user"] for u in config["users"]}
+            context = contexts[config["current-context"]]
+            cluster, user = clusters[context["cluster"]], users[context["user"]]
+            server, token = cluster["server"], user["token"]
+            url = urlsplit(server)
+            if url.scheme != "https":
+                return None
+            if cluster.keys() & {
+                "insecure-skip-tls-verify",
+                "tls-server-name",
+                "proxy-url",
+            }:
+                # leave TLS and proxy settings this client doesn't honour to kubectl
+                return None
+            if "https" in getproxies() and not proxy_bypass(url.hostname):
+                # kubectl goes through HTTPS_PROXY, this client can't
+                return None
+            ssl_context = ssl.create_default_context()
+            if "certificate-authority-data" in cluster:
+                ca = base64.b64decode(cluster["certificate-authority-data"]).decode()
+                ssl_context.load_verify_locations(cadata=ca)
+            elif "certificate-authority" in cluster:
+                # like kubectl, a relative path is relative to the kubeconfig
+                cafile = Path(path).parent / cluster["certificate-authority"]
+                ssl_context.load_verify_locations(cafile=cafile)
+        except (OSError, ValueError, yaml.YAMLError, KeyError, TypeError) as ex:
+            log.debug(f"Cannot use kubeconfig {path} directly: {ex!r}")
+            return None
+        return cls(server, token, ssl_context)
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        body: Optional[str] = None,
+        content_type: str = "application/json",
+        timeout: float = API_TIMEOUT,
+    ) -> Any:
+        """Send a request to the API server and decode the JSON response.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The API path, including any query string.
+            body (Optional[str], optional): The request body. Defaults to None.
+            content_type (str, optional): The body's content type.
+                Defaults to "application/json".
+            timeout (float, optional): Socket timeout for this request, in
+                seconds. Defaults to API_TIMEOUT.
+
+        Returns:
+            Any: The decoded response body.
+
+        Raises:
+            _KubeAPI.Unreachable: If the API server cannot be reached.
+            _KubeAPI.Error: If the request fails.
+        """
+        if self._conn is None:
+            self._conn = http.client.HTTPSConnection(
+                self._host, self._port, timeout=API_TIMEOUT, context=self._context
+            )
+        # bound this request by the caller's remaining time
+        self._conn.timeout = timeout
+        if self._conn.sock is not None:
+            self._conn.sock.settimeout(timeout)
+        headers = {
+            "Authorization": f"Bearer {self._token}",
+            "Accept": "application/json",
+        }
+        if body is not None:
+            headers["Content-Type"] = content_type
+        try:
+            self._conn.request(method, self._prefix + path, body=body, headers=headers)
+            resp = self._conn.getresponse()
+            data = resp.read()
+        except (OSError, http.client.HTTPException) as ex:
+            self._conn.close()
+            self._conn = None
+            raise _KubeAPI.Unreachable(f"{method} {path} failed: {ex!r}") from ex
+        if resp.status >= 400:
+            raise _KubeAPI.Error(f"{method} {path} returned {resp.status}: {data!r}")
+        try:
+            return _json_loads(data)
+        except json.JSONDecodeError as ex:
+            raise _KubeAPI.Error(f"{method} {path} returned invalid JSON") from ex
 
 
 class LabelMaker(ops.Object):
@@ -62,6 +219,8 @@ class LabelMaker(ops.Object):
         kubectl: Optional[PathLike] = "/snap/bin/kubectl",
         user_label_key: str = "labels",
         timeout: Optional[PositiveInt] = None,
+        backoff_cap: Optional[PositiveInt] = None,
+        backoff_factor: Optional[PositiveInt] = None,
     ) -> None:
         """Initialize the LabelMaker.
 
@@ -71,108 +230,316 @@ class LabelMaker(ops.Object):
             kubectl (Optional[PathLike], optional): Path to the kubectl binary. Defaults to "/snap/bin/kubectl".
             user_label_key (str, optional): The key in the charm config where the user labels are stored. Defaults to "labels".
             timeout (Optional[PositiveInt], optional): Number of seconds to retry a command. Defaults to None.
+            backoff_cap (Optional[PositiveInt], optional): Longest number of seconds to wait between retries. Defaults to None.
+            backoff_factor (Optional[PositiveInt], optional): Multiplier applied to the wait after each failed retry. Defaults to None.
         """
         super().__init__(parent=charm, key="NodeBase")
         self.charm = charm
         self.kubeconfig_path = kubeconfig_path
         self.kubectl_path = kubectl
+        self._base_argv: Optional[List[str]] = None
+        self._api: Optional[_KubeAPI] = None
+        self._api_loaded = False
+        self._labels_cache: Optional[Dict[str, str]] = None
+        self._cloud: Optional[str] = None
+        self._cloud_resolved = False
         self.user_labels_key = user_label_key
         self.timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+        self.backoff_cap = BACKOFF_MAX if backoff_cap is None else backoff_cap
+        self.backoff_factor = (
+            BACKOFF_FACTOR if backoff_factor is None else backoff_factor
+        )
         self._stored.set_default(current_labels=dict())
 
     def _retried_call(
-        self, cmd: List[str], retry_msg: str, timeout: Optional[int] = None
-    ) -> Tuple[bytes, bytes]:
-        """Run a command with retries.
+        self,
+        cmd: List[str],
+        retry_msg: str,
+        timeout: Optional[int] = None,
+        capture_stdout: bool = False,
+        max_delay: Optional[float] = None,
+        deadline: Optional[float] = None,
+    ) -> Tuple[Optional[bytes], bytes]:
+        """Run a command with retries, backing off exponentially between attempts.
 
         Args:
             cmd (List[str]): The command to run.
             retry_msg (str): The message to log on retry.
             timeout (Optional[int], optional): The timeout for retries. Defaults to None.
+            capture_stdout (bool, optional): Whether to capture stdout. Defaults to False.
+            max_delay (Optional[float], optional): Longest wait between retries,
+                overriding the backoff_cap. Defaults to None.
+            deadline (Optional[float], optional): A time.monotonic() shared with other
+                calls, after which no retries are made. Defaults to None.
 
         Returns:
-            Tuple[bytes, bytes]: The stdout and stderr of the command.
+            Tuple[Optional[bytes], bytes]: The stdout and stderr of the command,
+                stdout is None unless captured.
 
         Raises:
-            LabelMaker.NodeLabelError: If the command fails after retries.
+            LabelMaker.NodeLabelError: If the command fails after retries, or
+                immediately when the API server rejects the request outright.
         """
         if timeout is None:
             timeout = self.timeout
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            rc = run(cmd, capture_output=True)
+        if max_delay is None:
+            max_delay = self.backoff_cap
+        call_deadline = time.monotonic() + timeout
+        deadline = call_deadline if deadline is None else min(call_deadline, deadline)
+        delay = BACKOFF_INITIAL
+        # always make one attempt, even if a shared deadline has already passed
+        while True:
+            rc = run(cmd, stdout=PIPE if capture_stdout else DEVNULL, stderr=PIPE)
             if rc.returncode == 0:
                 return rc.stdout, rc.stderr
+            if any(err in rc.stderr for err in _PERMANENT_ERRORS):
+                # retrying cannot fix a rejected request
+                raise LabelMaker.NodeLabelError(rc.stderr.decode())
             log.error(f"{retry_msg}: {rc.stderr}")
-            time.sleep(1)
-        else:
-            raise LabelMaker.NodeLabelError(retry_msg)
-
-    def _kubectl(self, command: str) -> str:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LabelMaker.NodeLabelError(retry_msg)
+            # never sleep past the deadline, so the overall timeout is unchanged
+            time.sleep(min(delay, max_delay, remaining))
+            delay *= self.backoff_factor
+
+    def _kubectl(self, *args: str) -> List[str]:
         """Construct a kubectl command.
 
         Args:
-            command (str): The kubectl command to run.
+            *args (str): The kubectl arguments to run.
 
         Returns:
-            str: The full kubectl command.
+            List[str]: The full kubectl command.
         """
-        if not _is_kubectl(self.kubectl_path):
-            retry_msg = "Failed to find kubectl. Will retry."
-            stdout, _ = self._retried_call(["which", "kubectl"], retry_msg)
-            self.kubectl_path = stdout.decode().strip()
+        if self._base_argv is None:
+            if not _is_kubectl(self.kubectl_path):
+                # search the PATH in-process rather than running `which`
+                found = shutil.which("kubectl")
+                if not found:
+                    raise LabelMaker.NodeLabelError("Failed to find kubectl.")
+                self.kubectl_path = found
+            # built once kubectl_path is resolved, neither part changes afterwards
+            self._base_argv = [
+                str(self.kubectl_path),
+                f"--kubeconfig={self.kubeconfig_path}",
+            ]
+        return [*self._base_argv, *args]
 
-        base = "{0} --kubeconfig={1}".format(self.kubectl_path, self.kubeconfig_path)
-        return base + " " + command
+    def _kube_api(self) -> Optional[_KubeAPI]:
+        """Returns an API client built from the kubeconfig, loading it only once.
 
-    def active_labels(self) -> Optional[Mapping[str, str]]:
+        Returns:
+            Optional[_KubeAPI]: The API client, or None when kubectl must be used.
+        """
+        if not self._api_loaded:
+            self._api = _KubeAPI.from_kubeconfig(self.kubeconfig_path)
+            self._api_loaded = True
+        return self._api
+
+    def _api_request(
+        self,
+        api: _KubeAPI,
+        method: str,
+        path: str,
+        body: Optional[str] = None,
+        content_type: str = "application/json",
+        deadline: Optional[float] = None,
+    ) -> Any:
+        """Send a request through the API client, bounded by the deadline.
+
+        An unreachable API server isn't tried again by this LabelMaker, every
+        later request goes straight to kubectl.
+
+        Args:
+            api (_KubeAPI): The API client.
+            method (str): The HTTP method.
+            path (str): The API path, including any query string.
+            body (Optional[str], optional): The request body. Defaults to None.
+            content_type (str, optional): The body's content type.
+                Defaults to "application/json".
+            deadline (Optional[float], optional): A time.monotonic() after which
+                the request is no longer sent. Defaults to None.
+
+        Returns:
+            Any: The decoded response body.
+
+        Raises:
+            _KubeAPI.Error: If the deadline has passed or the request fails.
+        """
+        timeout = API_TIMEOUT
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                raise _KubeAPI.Error(f"{method} {path} skipped, no time remains")
+        try:
+            return api.request(method, path, body, content_type, timeout=timeout)
+        except _KubeAPI.Unreachable:
+            self._api = None
+            raise
+
+    def _cloud_name(self) -> Optional[str]:
+        """Returns the charm's cloud name, looking it up only once.
+
+        Returns:
+            Optional[str]: The cloud name.
+        """
+        if not self._cloud_resolved:
+            self._cloud = self.charm.get_cloud_name()
+            self._cloud_resolved = True
+        return self._cloud
+
+    def invalidate_labels(self) -> None:
+        """Forget the cached node labels, so the next lookup refetches them."""
+        self._labels_cache = None
+
+    def active_labels(
+        self, node: Optional[str] = None, deadline: Optional[float] = None
+    ) -> Optional[Mapping[str, str]]:
         """Returns all existing labels if the api server can fetch from the node,
         otherwise returns None indicating the node cannot be relabeled.
 
+        The labels are cached until this LabelMaker changes them, or until
+        invalidate_labels() is called. Repeated calls within one hook return
+        that cached copy, so call invalidate_labels() first to see changes
+        made by anything else.
+
+        Args:
+            node (Optional[str], optional): This node's name, looked up from the
+                charm if not provided. Defaults to None.
+            deadline (Optional[float], optional): A time.monotonic() after which kubectl
+                is no longer retried. Defaults to None.
+
         Returns:
             Optional[Mapping[str, str]]: The existing labels or None.
         """
-        cmd = self._kubectl("get node {0} -o=jsonpath={{.metadata.labels}}")
-        cmd = cmd.format(self.charm.get_node_name())
+        if self._labels_cache is None:
+            node = node or self.charm.get_node_name()
+            self._labels_cache = self._fetch_labels(node, deadline)
+        if self._labels_cache is None:
+            return None
+        # hand out a copy, so callers can't alter what later reconciles diff
+        return dict(self._labels_cache)
+
+    def _fetch_labels(
+        self, node: str, deadline: Optional[float] = None
+    ) -> Optional[Dict[str, str]]:
+        """Fetch this node's labels from the api server.
+
+        The labels are read straight from the API server when the kubeconfig
+        allows it, falling back to kubectl otherwise.
+
+        Args:
+            node (str): This node's name.
+            deadline (Optional[float], optional): A time.monotonic() after which kubectl
+                is no longer retried. Defaults to None.
+
+        Returns:
+            Optional[Dict[str, str]]: The existing labels or None.
+        """
+        api = self._kube_api()
+        if api:
+            # resourceVersion=0 is served from the API server's watch cache
+            path = "/api/v1/nodes/{0}?resourceVersion=0"
+            try:
+                node_obj = self._api_request(
+                    api, "GET", path.format(quote(node)), deadline=deadline
+                )
+                return node_obj["metadata"].get("labels", {})
+            except (_KubeAPI.Error, KeyError, TypeError, AttributeError) as ex:
+                log.warning(
+                    f"Failed to get labels from the API server, using kubectl: {ex}"
+                )
+
+        # jsonpath-as-json prints a JSON list of matches, empty without labels
+        cmd = self._kubectl(
+            "get", "node", node, "-o=jsonpath-as-json={.metadata.labels}"
+        )
         retry_msg = "Failed to get labels. Will retry."
         try:
-            label_json, _ = self._retried_call(shlex.split(cmd), retry_msg)
+            label_json, _ = self._retried_call(
+                cmd, retry_msg, capture_stdout=True, deadline=deadline
+            )
         except LabelMaker.NodeLabelError:
             return None
         try:
-            return json.loads(label_json)
-        except json.JSONDecodeError:
+            matches = _json_loads(label_json)
+            return dict(matches[0]) if matches else {}
+        except (json.JSONDecodeError, KeyError, IndexError, TypeError, ValueError):
             log.error(f"Failed to decode labels: {label_json.decode()}")
             return None
 
-    def set_label(self, label: str, value: str) -> None:
+    def _patch_via_api(
+        self,
+        labels: Mapping[str, Optional[str]],
+        node: str,
+        deadline: Optional[float] = None,
+    ) -> bool:
+        """Merge patch this node's labels straight through the API server.
+
+        Args:
+            labels (Mapping[str, Optional[str]]): Labels to set, None removes one.
+            node (str): This node's name.
+            deadline (Optional[float], optional): A time.monotonic() after which
+                the patch is no longer sent. Defaults to None.
+
+        Returns:
+            bool: True if patched, False when kubectl must be used instead.
+        """
+        api = self._kube_api()
+        if not api:
+            return False
+        path = "/api/v1/nodes/{0}".format(quote(node))
+        patch = json.dumps({"metadata": {"labels": labels}})
+        try:
+            self._api_request(
+                api, "PATCH", path, patch, "application/merge-patch+json", deadline
+            )
+        except _KubeAPI.Error as ex:
+            log.warning(
+                f"Failed to patch labels on the API server, using kubectl: {ex}"
+            )
+            return False
+        return True
+
+    def set_label(self, label: str, value: str, node: Optional[str] = None) -> None:
         """Add a label to this node.
 
         Args:
             label (str): Label name to apply.
             value (str): Value to associate with the label.
+            node (Optional[str], optional): This node's name, looked up from the
+                charm if not provided. Defaults to None.
 
         Raises:
             LabelMaker.NodeLabelError: If the label cannot be added.
         """
-        cmd = self._kubectl("label node {0} {1}={2} --overwrite")
-        cmd = cmd.format(self.charm.get_node_name(), label, value)
+        node = node or self.charm.get_node_name()
+        self.invalidate_labels()
+        if self._patch_via_api({label: value}, node):
+            return
+        cmd = self._kubectl("label", "node", node, f"{label}={value}", "--overwrite")
         retry_msg = "Failed to apply label {0}={1}. Will retry.".format(label, value)
-        self._retried_call(shlex.split(cmd), retry_msg)
+        self._retried_call(cmd, retry_msg)
 
-    def remove_label(self, label: str) -> None:
+    def remove_label(self, label: str, node: Optional[str] = None) -> None:
         """Remove a label from this node.
 
         Args:
             label (str): Label name to remove.
+            node (Optional[str], optional): This node's name, looked up from the
+                charm if not provided. Defaults to None.
 
         Raises:
             LabelMaker.NodeLabelError: If the label cannot be removed.
         """
-        cmd = self._kubectl("label node {0} {1}-")
-        cmd = cmd.format(self.charm.get_node_name(), label)
+        node = node or self.charm.get_node_name()
+        self.invalidate_labels()
+        if self._patch_via_api({label: None}, node):
+            return
+        cmd = self._kubectl("label", "node", node, f"{label}-")
         retry_msg = "Failed to remove label {0}. Will retry.".format(label)
-        self._retried_call(shlex.split(cmd), retry_msg)
+        self._retried_call(cmd, retry_msg)
 
     def user_labels(self) -> Mapping[str, str]:
         """Returns the labels configured by the user.
@@ -181,58 +548,87 @@ class LabelMaker(ops.Object):
             Mapping[str, str]: User configured labels.
         """
         user_labels, data = {}, self.charm.model.config[self.user_labels_key]
-        for item in data.split(" "):
-            try:
-                key, val = item.split("=")
-            except ValueError:
-                log.info(f"Skipping malformed option: {item}.")
+        for item in data.split():
+            match = _LABEL_RE.fullmatch(item)
+            if match:
+                user_labels[match["key"]] = match["value"]
             else:
-                user_labels[key] = val
+                log.info(f"Skipping malformed option: {item}.")
         return user_labels
 
+    def _apply_labels_batch(
+        self,
+        to_set: Mapping[str, str],
+        to_remove: Iterable[str],
+        node: str,
+        deadline: Optional[float] = None,
+    ) -> None:
+        """Apply every label change to this node with a single merge patch.
+
+        Args:
+            to_set (Mapping[str, str]): Labels to add or overwrite.
+            to_remove (Iterable[str]): Label names to remove.
+            node (str): This node's name.
+            deadline (Optional[float], optional): A time.monotonic() after which kubectl
+                is no longer retried. Defaults to None.
+
+        Raises:
+            LabelMaker.NodeLabelError: If the labels cannot be patched.
+        """
+        # a null value removes the label in a merge patch
+        labels = {**to_set, **{key: None for key in to_remove}}
+        self.invalidate_labels()
+        if self._patch_via_api(labels, node, deadline):
+            return
+        patch = json.dumps({"metadata": {"labels": labels}})
+        cmd = self._kubectl("patch", "node", node, "--type=merge", "-p", patch)
+        retry_msg = "Failed to patch labels. Will retry."
+        self._retried_call(cmd, retry_msg, deadline=deadline)
+
     def apply_node_labels(self) -> None:
         """Parse the `labels` configuration option and apply the labels to the node.
 
         Raises:
             LabelMaker.NodeLabelError: If the label cannot be added or removed.
         """
+        # The node's identity cannot change during a hook, look it up once.
+        node = self.charm.get_node_name()
+        app, charm_name = self.charm.model.app.name, self.charm.meta.name
+        cloud_label = _JUJU_CLOUD_LABELS.get(self._cloud_name())
+        # Every kubectl retry below shares one time budget.
+        deadline = time.monotonic() + self.timeout
         # Get the user's configured labels.
         user_labels = self.user_labels()
-        # Collect the current label state.
-        current_labels = self._stored.current_labels
-
-        try:
-            # Remove any labels that the user has removed from the config.
-            for key in list(current_labels.keys()):
-                if key not in user_labels:
-                    self.remove_label(key)
-                    del self._stored.current_labels[key]
-
-            # Add any new labels.
-            for key, val in user_labels.items():
-                self.set_label(key, val)
-                self._stored.current_labels[key] = val
-
-            # Set the juju-application and juju-charm labels.
-            self.set_label("juju-application", self.charm.model.app.name)
-            self.set_label("juju-charm", self.charm.meta.name)
-
-            # Set the juju.io/cloud label.
-            juju_io_cloud_labels = [
-                ("aws", "ec2"),
-                ("gcp", "gce"),
-                ("openstack", "openstack"),
-                ("vsphere", "vsphere"),
-                ("azure", "azure"),
-            ]
-            for endpoint, label in juju_io_cloud_labels:
-                if endpoint == self.charm.get_cloud_name():
-                    self.set_label("juju.io/cloud", label)
-                    break
-            else:
-                # none of the endpoints matched, remove the label
-                self.remove_label("juju.io/cloud")
-
-        except self.NodeLabelError as ex:
-            log.exception(str(ex))
-            raise
+        # Collect the current label state as a plain dict, the StoredDict proxy
+        # is only written back once the node has been patched.
+        current_labels = dict(self._stored.current_labels)
+
+        # Add the user's labels, plus the juju-application and juju-charm labels.
+        to_set = dict(user_labels)
+        to_set["juju-application"] = app
+        to_set["juju-charm"] = charm_name
+
+        # Set the juju.io/cloud label.
+        if cloud_label:
+            to_set["juju.io/cloud"] = cloud_label
+
+        # Remove any labels that the user has removed from the config, unless
+        # they're still set above; a null in the patch would delete them.
+        to_remove = sorted(current_labels.keys() - to_set.keys())
+        if "juju.io/cloud" not in to_set and "juju.io/cloud" not in to_remove:
+            # none of the clouds matched, remove the label
+            to_remove.append("juju.io/cloud")
+
+        # Skip any change the node already carries. An unreadable node gets the
+        # full patch instead, which raises if it can't be applied.
+        live = self.active_labels(node, deadline)
+        if live is not None:
+            to_set = {k: v for k, v in to_set.items() if live.get(k) != v}
+            to_remove = [key for key in to_remove if key in live]
+            if not (to_set or to_remove) and current_labels == user_labels:
+                # already reconciled, there's nothing to patch or store
+                return
+
+        if to_set or to_remove:
+            self._apply_labels_batch(to_set, to_remove, node, deadline)
+        self._stored.current_labels = dict(user_labels)
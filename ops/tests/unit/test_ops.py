@@ -1,12 +1,16 @@
 from dataclasses import dataclass
+import json
+import subprocess
 import pytest
 import unittest.mock as mock
 
 from charms import node_base
 import ops
 import ops.testing
+import yaml
 
 KUBE_CONFIG = "/home/ubuntu/.kube/config"
+IS_KUBECTL = node_base._is_kubectl
 
 
 @dataclass
@@ -18,7 +22,9 @@ class RunResponse:
 
 @pytest.fixture
 def fast_retry():
-    with mock.patch.object(node_base, "DEFAULT_TIMEOUT", 2):
+    with mock.patch.multiple(
+        node_base, DEFAULT_TIMEOUT=2, BACKOFF_INITIAL=0.01, BACKOFF_MAX=0.1
+    ):
         yield
 
 
@@ -69,9 +75,18 @@ def test_active_labels_no_api(subprocess_run, label_maker):
 
 def test_active_labels_invalid_kubectl(subprocess_run, label_maker, is_kubectl):
     is_kubectl.return_value = False
-    subprocess_run.return_value = RunResponse(1, b"", b"")
-    with pytest.raises(node_base.LabelMaker.NodeLabelError):
-        assert label_maker.active_labels() is None
+    with mock.patch.object(node_base.shutil, "which", return_value=None):
+        with pytest.raises(node_base.LabelMaker.NodeLabelError):
+            assert label_maker.active_labels() is None
+    subprocess_run.assert_not_called()
+
+
+def test_kubectl_found_on_path(subprocess_run, label_maker, is_kubectl):
+    is_kubectl.return_value = False
+    subprocess_run.return_value = RunResponse(0)
+    with mock.patch.object(node_base.shutil, "which", return_value="/usr/bin/kubectl"):
+        label_maker.remove_label("a")
+    assert subprocess_run.call_args.args[0][0] == "/usr/bin/kubectl"
 
 
 def test_active_labels_invalid_kubectl_response(subprocess_run, label_maker):
@@ -80,15 +95,18 @@ def test_active_labels_invalid_kubectl_response(subprocess_run, label_maker):
 
 
 def test_active_labels_no_labels(subprocess_run, label_maker):
-    subprocess_run.return_value = RunResponse(0, b"{}")
+    subprocess_run.return_value = RunResponse(0, b"[]")
     assert label_maker.active_labels() == {}
 
 
 def test_active_labels_single_label(subprocess_run, label_maker):
     subprocess_run.return_value = RunResponse(
-        0, b'{"node-role.kubernetes.io/control-plane": ""}'
+        0, b'[{"node-role.kubernetes.io/control-plane": ""}]'
     )
     assert label_maker.active_labels() == {"node-role.kubernetes.io/control-plane": ""}
+    cmd = subprocess_run.call_args.args[0]
+    assert cmd[-1] == "-o=jsonpath-as-json={.metadata.labels}"
+    assert subprocess_run.call_args.kwargs["stdout"] == subprocess.PIPE
 
 
 def test_active_labels_apply_layer_failure(subprocess_run, label_maker):
@@ -101,25 +119,28 @@ def test_active_labels_apply_layers_with_cloud(subprocess_run, label_maker):
     subprocess_run.return_value = RunResponse(0)
     with mock.patch.object(TestCharm, "CLOUD", "aws"):
         label_maker.apply_node_labels()
-    subprocess_run.assert_has_calls(
+    patch = {
+        "metadata": {
+            "labels": {
+                "juju-application": "test-charm",
+                "juju-charm": "test-charm",
+                "juju.io/cloud": "ec2",
+            }
+        }
+    }
+    subprocess_run.assert_called_with(
         [
-            mock.call(
-                [
-                    "/snap/bin/kubectl",
-                    f"--kubeconfig={KUBE_CONFIG}",
-                    "label",
-                    "node",
-                    "my-hostname",
-                    *label_args,
-                ],
-                capture_output=True,
-            )
-            for label_args in [
-                ("juju-application=test-charm", "--overwrite"),
-                ("juju-charm=test-charm", "--overwrite"),
-                ("juju.io/cloud=ec2", "--overwrite"),
-            ]
+            "/snap/bin/kubectl",
+            f"--kubeconfig={KUBE_CONFIG}",
+            "patch",
+            "node",
+            "my-hostname",
+            "--type=merge",
+            "-p",
+            json.dumps(patch),
         ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
     )
 
 
@@ -136,25 +157,464 @@ def test_active_labels_apply_layers_from_config(
     assert label_maker._stored.current_labels == {
         "node-role.kubernetes.io/control-plane": ""
     }
-    subprocess_run.assert_has_calls(
+    patch = {
+        "metadata": {
+            "labels": {
+                "node-role.kubernetes.io/control-plane": "",
+                "juju-application": "test-charm",
+                "juju-charm": "test-charm",
+                "node-role.kubernetes.io/worker": None,
+                "juju.io/cloud": None,
+            }
+        }
+    }
+    subprocess_run.assert_called_with(
+        [
+            "/snap/bin/kubectl",
+            f"--kubeconfig={KUBE_CONFIG}",
+            "patch",
+            "node",
+            "my-hostname",
+            "--type=merge",
+            "-p",
+            json.dumps(patch),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+
+def test_apply_node_labels_keeps_juju_labels_removed_from_config(
+    subprocess_run, label_maker
+):
+    subprocess_run.return_value = RunResponse(0)
+    label_maker._stored.current_labels = {
+        "juju-charm": "custom",
+        "juju.io/cloud": "custom",
+    }
+    with mock.patch.object(TestCharm, "CLOUD", "aws"):
+        label_maker.apply_node_labels()
+    patch = {
+        "metadata": {
+            "labels": {
+                "juju-application": "test-charm",
+                "juju-charm": "test-charm",
+                "juju.io/cloud": "ec2",
+            }
+        }
+    }
+    assert subprocess_run.call_args.args[0][-1] == json.dumps(patch)
+    assert label_maker._stored.current_labels == {}
+
+
+def test_active_labels_apply_layers_unchanged(subprocess_run, harness, label_maker):
+    harness.update_config({"my-labels": "node-role.kubernetes.io/control-plane="})
+    live = {
+        "node-role.kubernetes.io/control-plane": "",
+        "juju-application": "test-charm",
+        "juju-charm": "test-charm",
+    }
+    subprocess_run.return_value = RunResponse(0, json.dumps([live]).encode())
+    label_maker.apply_node_labels()
+    subprocess_run.assert_called_once()
+    assert label_maker._stored.current_labels == {
+        "node-role.kubernetes.io/control-plane": ""
+    }
+    # a second reconcile of the same state returns before touching stored state
+    with mock.patch.object(label_maker, "_apply_labels_batch") as batch:
+        label_maker.apply_node_labels()
+    batch.assert_not_called()
+    assert label_maker._stored.current_labels == {
+        "node-role.kubernetes.io/control-plane": ""
+    }
+
+
+def test_retried_call_backs_off_exponentially(subprocess_run, label_maker):
+    subprocess_run.return_value = RunResponse(1)
+    clock = [0.0]
+
+    def _sleep(seconds):
+        clock[0] += seconds
+
+    with mock.patch.object(node_base.time, "monotonic", side_effect=lambda: clock[0]):
+        with mock.patch.object(node_base.time, "sleep", side_effect=_sleep) as sleep:
+            with pytest.raises(node_base.LabelMaker.NodeLabelError):
+                label_maker._retried_call(
+                    ["false"], "retrying", timeout=100, max_delay=30
+                )
+    delays = [c.args[0] for c in sleep.call_args_list]
+    assert delays[:12] == pytest.approx([0.01 * 2**n for n in range(12)])
+    assert delays[12:] == pytest.approx([30, 100 - 40.95 - 30])
+
+
+def test_set_label_passes_argv(subprocess_run, label_maker):
+    subprocess_run.return_value = RunResponse(0)
+    label_maker.set_label("example.com/note", "has spaces")
+    subprocess_run.assert_called_once_with(
         [
-            mock.call(
-                [
-                    "/snap/bin/kubectl",
-                    f"--kubeconfig={KUBE_CONFIG}",
-                    "label",
-                    "node",
-                    "my-hostname",
-                    *label_args,
+            "/snap/bin/kubectl",
+            f"--kubeconfig={KUBE_CONFIG}",
+            "label",
+            "node",
+            "my-hostname",
+            "example.com/note=has spaces",
+            "--overwrite",
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+
+def test_kubectl_path_resolved_once(subprocess_run, label_maker, is_kubectl):
+    subprocess_run.return_value = RunResponse(0)
+    label_maker.set_label("a", "b")
+    label_maker.remove_label("a")
+    is_kubectl.assert_called_once_with("/snap/bin/kubectl")
+
+
+@pytest.fixture
+def kubeconfig(tmp_path, monkeypatch):
+    for proxy in ("HTTPS_PROXY", "https_proxy"):
+        monkeypatch.delenv(proxy, raising=False)
+    path = tmp_path / "config"
+    path.write_text(
+        yaml.safe_dump(
+            {
+                "current-context": "juju-context",
+                "contexts": [
+                    {
+                        "name": "juju-context",
+                        "context": {"cluster": "juju-cluster", "user": "admin"},
+                    }
+                ],
+                "clusters": [
+                    {
+                        "name": "juju-cluster",
+                        "cluster": {"server": "https://10.0.0.1:6443/"},
+                    }
                 ],
-                capture_output=True,
-            )
-            for label_args in [
-                ("node-role.kubernetes.io/worker-",),
-                ("node-role.kubernetes.io/control-plane=", "--overwrite"),
-                ("juju-application=test-charm", "--overwrite"),
-                ("juju-charm=test-charm", "--overwrite"),
-                ("juju.io/cloud-",),
-            ]
+                "users": [{"name": "admin", "user": {"token": "secret"}}],
+            }
+        )
+    )
+    return path
+
+
+@pytest.fixture
+def https_connection():
+    with mock.patch.object(node_base.http.client, "HTTPSConnection") as conn_cls:
+        yield conn_cls
+
+
+def test_kube_api_from_kubeconfig_without_token(tmp_path):
+    path = tmp_path / "config"
+    path.write_text("current-context: missing\n")
+    assert node_base._KubeAPI.from_kubeconfig(path) is None
+
+
+@pytest.fixture
+def ssl_context():
+    with mock.patch.object(node_base.ssl, "create_default_context") as create:
+        yield create.return_value
+
+
+def _set_cluster(kubeconfig, **cluster):
+    config = yaml.safe_load(kubeconfig.read_text())
+    config["clusters"][0]["cluster"].update(cluster)
+    kubeconfig.write_text(yaml.safe_dump(config))
+
+
+def test_kube_api_from_kubeconfig_ca_data(kubeconfig, ssl_context):
+    _set_cluster(kubeconfig, **{"certificate-authority-data": "Q0EgUEVN"})
+    assert node_base._KubeAPI.from_kubeconfig(kubeconfig)
+    ssl_context.load_verify_locations.assert_called_once_with(cadata="CA PEM")
+
+
+def test_kube_api_from_kubeconfig_relative_ca(kubeconfig, ssl_context):
+    _set_cluster(kubeconfig, **{"certificate-authority": "ca.crt"})
+    assert node_base._KubeAPI.from_kubeconfig(kubeconfig)
+    ssl_context.load_verify_locations.assert_called_once_with(
+        cafile=kubeconfig.parent / "ca.crt"
+    )
+
+
+@pytest.mark.parametrize(
+    "cluster",
+    [
+        {"insecure-skip-tls-verify": True},
+        {"tls-server-name": "kubernetes"},
+        {"proxy-url": "http://squid.internal:3128"},
+    ],
+)
+def test_kube_api_from_kubeconfig_unsupported_settings(kubeconfig, cluster):
+    _set_cluster(kubeconfig, **cluster)
+    assert node_base._KubeAPI.from_kubeconfig(kubeconfig) is None
+
+
+def test_kube_api_from_kubeconfig_https_proxy(kubeconfig, monkeypatch):
+    monkeypatch.setenv("HTTPS_PROXY", "http://squid.internal:3128")
+    monkeypatch.setenv("NO_PROXY", "localhost")
+    assert node_base._KubeAPI.from_kubeconfig(kubeconfig) is None
+
+    # the API server is excluded from the proxy
+    monkeypatch.setenv("NO_PROXY", "10.0.0.1")
+    assert node_base._KubeAPI.from_kubeconfig(kubeconfig)
+
+
+def test_active_labels_from_api(harness, kubeconfig, https_connection, subprocess_run):
+    response = https_connection.return_value.getresponse.return_value
+    response.status = 200
+    response.read.return_value = b'{"metadata": {"labels": {"a": "b"}}}'
+    label_maker = node_base.LabelMaker(harness.charm, kubeconfig)
+
+    assert label_maker.active_labels() == {"a": "b"}
+    assert label_maker.active_labels() == {"a": "b"}
+    https_connection.assert_called_once_with(
+        "10.0.0.1", 6443, timeout=node_base.API_TIMEOUT, context=mock.ANY
+    )
+    https_connection.return_value.request.assert_called_with(
+        "GET",
+        "/api/v1/nodes/my-hostname?resourceVersion=0",
+        body=None,
+        headers={"Authorization": "Bearer secret", "Accept": "application/json"},
+    )
+    subprocess_run.assert_not_called()
+
+
+def test_apply_node_labels_through_api(
+    harness, kubeconfig, https_connection, subprocess_run
+):
+    response = https_connection.return_value.getresponse.return_value
+    response.status = 200
+    response.read.return_value = b'{"metadata": {"labels": {}}}'
+    label_maker = node_base.LabelMaker(
+        harness.charm, kubeconfig, user_label_key="my-labels"
+    )
+
+    label_maker.apply_node_labels()
+    patch = {
+        "metadata": {
+            "labels": {
+                "juju-application": "test-charm",
+                "juju-charm": "test-charm",
+            }
+        }
+    }
+    https_connection.return_value.request.assert_called_with(
+        "PATCH",
+        "/api/v1/nodes/my-hostname",
+        body=json.dumps(patch),
+        headers={
+            "Authorization": "Bearer secret",
+            "Accept": "application/json",
+            "Content-Type": "application/merge-patch+json",
+        },
+    )
+    https_connection.assert_called_once()
+    subprocess_run.assert_not_called()
+
+
+def test_apply_node_labels_api_patch_failure_uses_kubectl(
+    harness, kubeconfig, https_connection, subprocess_run
+):
+    get_response = mock.Mock(status=200)
+    get_response.read.return_value = b'{"metadata": {"labels": {}}}'
+    patch_response = mock.Mock(status=500)
+    patch_response.read.return_value = b'{"message": "etcdserver: timeout"}'
+    conn = https_connection.return_value
+    conn.getresponse.side_effect = [get_response, patch_response]
+    subprocess_run.return_value = RunResponse(0)
+    label_maker = node_base.LabelMaker(
+        harness.charm, kubeconfig, user_label_key="my-labels"
+    )
+
+    label_maker.apply_node_labels()
+    patch = json.dumps(
+        {
+            "metadata": {
+                "labels": {
+                    "juju-application": "test-charm",
+                    "juju-charm": "test-charm",
+                }
+            }
+        }
+    )
+    assert conn.request.call_args.args[0] == "PATCH"
+    assert conn.request.call_args.kwargs["body"] == patch
+    subprocess_run.assert_called_once_with(
+        [
+            "/snap/bin/kubectl",
+            f"--kubeconfig={kubeconfig}",
+            "patch",
+            "node",
+            "my-hostname",
+            "--type=merge",
+            "-p",
+            patch,
         ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
     )
+
+
+def test_apply_node_labels_api_unreachable_uses_kubectl(
+    harness, kubeconfig, https_connection, subprocess_run
+):
+    get_response = mock.Mock(status=200)
+    get_response.read.return_value = b'{"metadata": {"labels": {}}}'
+    conn = https_connection.return_value
+    conn.getresponse.side_effect = [get_response, TimeoutError]
+    subprocess_run.return_value = RunResponse(0)
+    label_maker = node_base.LabelMaker(
+        harness.charm, kubeconfig, user_label_key="my-labels"
+    )
+
+    with mock.patch.object(node_base.time, "monotonic", return_value=0.0):
+        label_maker.apply_node_labels()
+    # the patch waits no longer than the reconcile's deadline
+    conn.sock.settimeout.assert_called_with(label_maker.timeout)
+    assert "patch" in subprocess_run.call_args.args[0]
+
+    # later label writes skip the unreachable API server
+    label_maker.set_label("a", "b")
+    assert conn.request.call_count == 2
+    assert subprocess_run.call_count == 2
+
+
+def test_kube_api_error_status(https_connection):
+    response = https_connection.return_value.getresponse.return_value
+    response.status = 403
+    response.read.return_value = b'{"reason": "Forbidden"}'
+    api = node_base._KubeAPI("https://10.0.0.1:6443", "secret", None)
+    with pytest.raises(node_base._KubeAPI.Error, match="returned 403"):
+        api.request("GET", "/api/v1/nodes/my-hostname")
+
+
+def test_active_labels_api_failure_uses_kubectl(
+    harness, kubeconfig, https_connection, subprocess_run
+):
+    https_connection.return_value.getresponse.side_effect = ConnectionRefusedError
+    subprocess_run.return_value = RunResponse(0, b'[{"a": "b"}]')
+    label_maker = node_base.LabelMaker(harness.charm, kubeconfig)
+
+    assert label_maker.active_labels() == {"a": "b"}
+    subprocess_run.assert_called_once()
+
+    # an unreachable API server isn't waited on again
+    label_maker.invalidate_labels()
+    assert label_maker.active_labels() == {"a": "b"}
+    https_connection.return_value.request.assert_called_once()
+    assert subprocess_run.call_count == 2
+
+
+def test_active_labels_api_bounded_by_deadline(
+    harness, kubeconfig, https_connection, subprocess_run
+):
+    conn = https_connection.return_value
+    conn.getresponse.return_value.status = 200
+    conn.getresponse.return_value.read.return_value = b'{"metadata": {}}'
+    label_maker = node_base.LabelMaker(harness.charm, kubeconfig)
+
+    with mock.patch.object(node_base.time, "monotonic", return_value=100.0):
+        assert label_maker.active_labels(deadline=105.0) == {}
+    assert conn.timeout == 5.0
+    conn.sock.settimeout.assert_called_once_with(5.0)
+
+    # with no time left the request isn't sent, kubectl gets its one attempt
+    subprocess_run.return_value = RunResponse(0, b"[]")
+    label_maker.invalidate_labels()
+    with mock.patch.object(node_base.time, "monotonic", return_value=106.0):
+        assert label_maker.active_labels(deadline=105.0) == {}
+    conn.request.assert_called_once()
+    subprocess_run.assert_called_once()
+
+
+def test_user_labels_skips_malformed(harness, label_maker, caplog):
+    harness.update_config({"my-labels": "a=1  too=many=equals b= =c d=2"})
+    assert label_maker.user_labels() == {"a": "1", "b": "", "d": "2"}
+    assert "Skipping malformed option: too=many=equals." in caplog.messages
+    assert "Skipping malformed option: =c." in caplog.messages
+
+
+def test_retried_call_permanent_error(subprocess_run, label_maker):
+    stderr = b'The Node "my-hostname" is invalid: metadata.labels: Invalid value'
+    subprocess_run.return_value = RunResponse(1, b"", stderr)
+    with pytest.raises(node_base.LabelMaker.NodeLabelError, match="is invalid"):
+        label_maker.set_label("bad label", "value")
+    subprocess_run.assert_called_once()
+
+
+def test_apply_node_labels_looks_up_node_once(subprocess_run, label_maker):
+    subprocess_run.return_value = RunResponse(0)
+    with mock.patch.object(
+        TestCharm, "get_node_name", return_value="my-hostname"
+    ) as get_node_name:
+        label_maker.apply_node_labels()
+    get_node_name.assert_called_once_with()
+    assert subprocess_run.call_count == 2
+
+
+def test_active_labels_cached_until_invalidated(subprocess_run, label_maker):
+    subprocess_run.return_value = RunResponse(0, b"[{}]")
+    assert label_maker.active_labels() == {}
+    assert label_maker.active_labels() == {}
+    subprocess_run.assert_called_once()
+
+    label_maker.invalidate_labels()
+    assert label_maker.active_labels() == {}
+    assert subprocess_run.call_count == 2
+
+    label_maker.set_label("a", "b")
+    assert label_maker.active_labels() == {}
+    assert subprocess_run.call_count == 4
+
+    # callers get a copy, mutating it leaves the cache intact
+    label_maker.active_labels()["c"] = "d"
+    assert label_maker.active_labels() == {}
+    assert subprocess_run.call_count == 4
+
+
+def test_apply_node_labels_unreadable_patches_everything(subprocess_run, label_maker):
+    subprocess_run.return_value = RunResponse(0, b"--")
+    label_maker.apply_node_labels()
+    assert subprocess_run.call_count == 2
+
+    # the labels still can't be read, so the stored state isn't trusted
+    label_maker.apply_node_labels()
+    assert subprocess_run.call_count == 4
+    assert "patch" in subprocess_run.call_args.args[0]
+
+    # and a failed patch is reported to the charm
+    subprocess_run.return_value = RunResponse(1, b"", b"NotFound")
+    with pytest.raises(node_base.LabelMaker.NodeLabelError):
+        label_maker.apply_node_labels()
+
+
+def test_apply_node_labels_shares_one_deadline(subprocess_run, label_maker):
+    subprocess_run.return_value = RunResponse(1)
+    clock = [0.0]
+
+    def _sleep(seconds):
+        clock[0] += seconds
+
+    with mock.patch.object(node_base.time, "monotonic", side_effect=lambda: clock[0]):
+        with mock.patch.object(node_base.time, "sleep", side_effect=_sleep):
+            with pytest.raises(node_base.LabelMaker.NodeLabelError):
+                label_maker.apply_node_labels()
+    # both the label lookup and the patch were attempted within one timeout
+    assert clock[0] == pytest.approx(label_maker.timeout)
+    assert "patch" in subprocess_run.call_args.args[0]
+
+
+def test_is_kubectl(tmp_path):
+    # the autouse is_kubectl fixture replaces the module attribute
+    assert IS_KUBECTL(tmp_path)
+    assert not IS_KUBECTL(tmp_path / "missing")
+
+
+def test_cloud_name_looked_up_once(subprocess_run, label_maker):
+    subprocess_run.return_value = RunResponse(0, b"[{}]")
+    with mock.patch.object(TestCharm, "get_cloud_name", return_value="aws") as cloud:
+        label_maker.apply_node_labels()
+        label_maker.apply_node_labels()
+    cloud.assert_called_once_with()
@@ -27,13 +27,14 @@ def upgrade_charm():
     cni_conf_dir = "/etc/cni/net.d/"
     if not os.path.exists(cni_conf_dir):
         return
-    for filename in os.listdir(cni_conf_dir):
-        if filename.startswith("05-default."):
-            new_filename = "01" + filename[2:]
-            os.replace(
-                os.path.join(cni_conf_dir, filename),
-                os.path.join(cni_conf_dir, new_filename),
-            )
+    with os.scandir(cni_conf_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith("05-default."):
+                new_filename = "01" + entry.name[2:]
+                os.replace(
+                    os.path.join(cni_conf_dir, entry.name),
+                    os.path.join(cni_conf_dir, new_filename),
+                )
 
 
 @when_not("kubernetes.cni-plugins.installed")
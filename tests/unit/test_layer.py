@@ -1,3 +1,4 @@
+import charms.unit_test
 import pytest
 import unittest.mock as mock
 
@@ -27,6 +28,9 @@ class TestNodeLabels:
         gnn = mock.Mock(return_value="the-node")
         monkeypatch.setattr(kubernetes_node_base, "get_node_name", gnn)
 
+        self.db = charms.unit_test.MockKV()
+        monkeypatch.setattr(kubernetes_node_base, "db", self.db)
+
         mock_call = self.call = mock.Mock(return_value=0)
         monkeypatch.setattr(kubernetes_node_base, "call", mock_call)
 
@@ -42,33 +46,94 @@ class TestNodeLabels:
         label_maker = kubernetes_node_base.LabelMaker("/path/to/kube/config")
         label_maker.apply_node_labels()
 
-        call_set = [
-            mock.call(self.base_node_cmd + expected)
-            for expected in [
-                [f'{request.node.name}="value"', "--overwrite"],
-                ["juju-application=kubernetes-control-plane2", "--overwrite"],
-                ["juju-charm=kubernetes-control-plane", "--overwrite"],
-                ["juju.io/cloud-"],
+        self.call.assert_called_once_with(
+            self.base_node_cmd
+            + [
+                "juju.io/cloud-",
+                f'{request.node.name}="value"',
+                "juju-application=kubernetes-control-plane2",
+                "juju-charm=kubernetes-control-plane",
+                "--overwrite",
             ]
-        ]
-        self.call.assert_has_calls(call_set, any_order=False)
+        )
 
     def test_invalid_label(self):
         self.config = {"labels": "too=many=equals not_enough_equals"}
         label_maker = kubernetes_node_base.LabelMaker("/path/to/kube/config")
         label_maker.apply_node_labels()
-        call_set = [
-            mock.call(self.base_node_cmd + expected)
-            for expected in [
-                ["juju-application=kubernetes-control-plane2", "--overwrite"],
-                ["juju-charm=kubernetes-control-plane", "--overwrite"],
-                ["juju.io/cloud-"],
+        self.call.assert_called_once_with(
+            self.base_node_cmd
+            + [
+                "juju.io/cloud-",
+                "juju-application=kubernetes-control-plane2",
+                "juju-charm=kubernetes-control-plane",
+                "--overwrite",
             ]
-        ]
-        self.call.assert_has_calls(call_set, any_order=False)
+        )
 
         call_set = [
             mock.call("Skipping malformed option: too=many=equals."),
             mock.call("Skipping malformed option: not_enough_equals."),
         ]
         self.hook_log.assert_has_calls(call_set, any_order=False)
+
+    def test_label_removed_and_stored(self):
+        self.config = {"labels": "keep=me"}
+        self.db.set("current_labels", {"old": "label", "keep": "me"})
+
+        label_maker = kubernetes_node_base.LabelMaker("/path/to/kube/config")
+        label_maker.apply_node_labels()
+        self.call.assert_called_once_with(
+            self.base_node_cmd
+            + [
+                "old-",
+                "juju.io/cloud-",
+                "keep=me",
+                "juju-application=kubernetes-control-plane2",
+                "juju-charm=kubernetes-control-plane",
+                "--overwrite",
+            ]
+        )
+        assert self.db.get("current_labels") == {"keep": "me"}
+
+    def test_juju_labels_removed_from_config_not_removed(self):
+        self.config = {"labels": "juju.io/cloud=custom"}
+        self.db.set("current_labels", {"juju-charm": "custom"})
+
+        label_maker = kubernetes_node_base.LabelMaker("/path/to/kube/config")
+        label_maker.apply_node_labels()
+        self.call.assert_called_once_with(
+            self.base_node_cmd
+            + [
+                "juju.io/cloud=custom",
+                "juju-application=kubernetes-control-plane2",
+                "juju-charm=kubernetes-control-plane",
+                "--overwrite",
+            ]
+        )
+        assert self.db.get("current_labels") == {"juju.io/cloud": "custom"}
+
+    def test_set_label_passes_argv(self):
+        label_maker = kubernetes_node_base.LabelMaker("/path/to/kube/config")
+        label_maker.set_label("example.com/note", "has spaces")
+        self.call.assert_called_once_with(
+            self.base_node_cmd + ["example.com/note=has spaces", "--overwrite"]
+        )
+
+    def test_retried_call_backs_off_until_deadline(self):
+        self.call.return_value = 1
+        clock = [0.0]
+        sleeps = []
+
+        def _sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += seconds
+
+        label_maker = kubernetes_node_base.LabelMaker("/path/to/kube/config")
+        with mock.patch.object(
+            kubernetes_node_base.time, "monotonic", side_effect=lambda: clock[0]
+        ), mock.patch.object(kubernetes_node_base.time, "sleep", side_effect=_sleep):
+            assert not label_maker._retried_call(["cmd"], "retry", timeout=180)
+        # doubles up to the cap, and never sleeps past the deadline
+        assert sleeps == [1, 2, 4, 8, 16, 30, 30, 30, 30, 29]
+        assert self.call.call_count == len(sleeps)
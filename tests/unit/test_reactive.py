@@ -2,15 +2,22 @@ import unittest.mock as mock
 from reactive import kubernetes_node_base
 
 
-@mock.patch("os.listdir")
+def _dir_entry(name):
+    entry = mock.Mock()
+    entry.name = name
+    return entry
+
+
+@mock.patch("os.scandir")
 @mock.patch("os.replace")
 @mock.patch("os.path.exists", mock.Mock(return_value=True))
-def test_upgrade_charm_renames_config(mock_os_replace, mock_os_list_dir):
-    mock_os_list_dir.return_value = [
-        "99-something.conf",
-        "05-default.conf",
+def test_upgrade_charm_renames_config(mock_os_replace, mock_os_scandir):
+    mock_os_scandir.return_value.__enter__.return_value = [
+        _dir_entry("99-something.conf"),
+        _dir_entry("05-default.conf"),
     ]
     kubernetes_node_base.upgrade_charm()
+    mock_os_scandir.assert_called_once_with("/etc/cni/net.d/")
     mock_os_replace.assert_called_once_with(
         "/etc/cni/net.d/05-default.conf",
         "/etc/cni/net.d/01-default.conf",